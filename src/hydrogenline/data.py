@@ -4,9 +4,10 @@ from matplotlib import pyplot as plt
 import json
 from datetime import datetime
 
-from hydrogenline.utils import Bar
+from hydrogenline.utils import Bar, display_columns, decimate_minmax, decimate_mean
 
-from typing import List, Dict
+from scipy.interpolate import BSpline, make_lsq_spline
+from typing import List, Dict, Tuple
 from numpy.typing import NDArray
 
 
@@ -32,6 +33,9 @@ def path_reference_data(name: str) -> Path:
 def path_reference_settings(name: str) -> Path:
     return path_reference() / f"{name}.json"
 
+def path_reference_model(name: str) -> Path:
+    return path_reference() / f"{name}_model.npy"
+
 def path_waterfall(name: str, window: str, format: str = "webp") -> Path:
     path = create_path(path_root(name) / "waterfall")
     return path / f"{window}.{format}"
@@ -57,6 +61,8 @@ class Measurement:
         self.center_freq: int = 0
 
         self.psd: Dict[str, NDArray[np.float64]] = {}
+        self.reference_psd: Dict[str, NDArray[np.float64]] = {}
+        self.correction: Dict[str, NDArray[np.float64]] = {}
         self.dates: List[datetime] = []
 
         # Load settings and measurement data
@@ -74,26 +80,35 @@ class Measurement:
 
         # Load reference measurement if specified
         if self.reference is not None:
-            self.reference_psd = np.load(path_reference_data(self.reference), allow_pickle=True).item()
-
-            with open(path_reference_settings(self.reference), "rb") as f:
-                reference_settings = json.loads(f.read())
+            reference = Reference(self.reference)
 
-            # Check if reference file is compatible with measurements
-            if not reference_settings["bins"] == self.bins:
-                print("ERROR: Reference measurement and measurement data have a different number of frequency bins.")
+            # The bandpass model can be evaluated on any frequency grid, as long as it lies within the reference band
+            f_min, f_max = self.frequencies[0], self.frequencies[-1]
+            f_ref_min, f_ref_max = reference.frequencies[0], reference.frequencies[-1]
+            if f_min < f_ref_min or f_max > f_ref_max:
+                print("ERROR: Measurement band is not covered by the reference measurement.")
                 exit(1)
 
-            if not reference_settings["sample_rate"] == self.sample_rate:
-                print("ERROR: Reference measurement and measurement data have a different sample rate.")
+            missing = [window for window in self.windows if window not in reference.windows]
+            if len(missing) > 0:
+                print(f"ERROR: Reference measurement has no data for window function(s): {', '.join(missing)}.")
                 exit(1)
 
-            if not reference_settings["center_freq"] == self.center_freq:
-                print("ERROR: Reference measurement and measurement data have a different center frequency.")
-                exit(1)
+            # The RTL2832U decimation filter, and so the bandpass shape, depends on the sample rate
+            if not reference.sample_rate == self.sample_rate:
+                print("WARNING: Reference measurement and measurement data have a different sample rate.")
 
-            if not reference_settings["gain"] == self.gain:
+            if not reference.gain == self.gain:
                 print("WARNING: Reference measurement and measurement data have different RTL-SDR gain settings.")
+
+            if not reference.on_grid(self.bins, self.sample_rate, self.center_freq) and any(len(reference.narrowband[window][0]) > 0 for window in self.windows):
+                print("WARNING: Reference measurement and measurement data have different frequency bins. Narrowband features of the reference, such as the DC spike, are not corrected.")
+
+            # Evaluate the bandpass model once on the measurement grid
+            self.reference_psd = dict((window, reference.bandpass(window, self.bins, self.sample_rate, self.center_freq)) for window in self.windows)
+
+            # Reference psd is normalized to its average power of the measured band to minimize influence on the absolute power of the measurement
+            self.correction = dict((window, np.mean(psd)/psd) for window, psd in self.reference_psd.items())
         else:
             print("ERROR: Non reference measurement specified.")
             exit(1)
@@ -137,8 +152,7 @@ class Measurement:
 
     def process(self, normalize: bool = True) -> Dict[str, NDArray[np.float64]]:
         # Remove frequency gain variation
-        # Reference psd is normalized to its average power of the measured band to minimize influence on the absolute power of the measurement
-        psds = dict((window, psd/self.reference_psd[window]*np.mean(self.reference_psd[window])) for window, psd in self.psd.items())
+        psds = dict((window, psd*self.correction[window]) for window, psd in self.psd.items())
 
         if normalize:
             psds_avg = dict((window, np.repeat(np.mean(psd, axis=1)[:, np.newaxis], self.bins, axis=1)) for window, psd in psds.items())
@@ -147,7 +161,7 @@ class Measurement:
 
         return psds
     
-    def save_waterfall(self, peak: float) -> None:
+    def save_waterfall(self, peak: float, decimate: bool = True) -> None:
         f_MHz = self.frequencies/1e6
 
         # Get y-axis labels from measurement timestamps
@@ -171,16 +185,23 @@ class Measurement:
             fig.set_facecolor("black")
             ax.set_title(f"{self.dates[0].strftime('%Y/%m/%d %H:%M')} - {self.dates[-1].strftime('%Y/%m/%d %H:%M')}", color="gray")
 
-            ax.imshow(psds, vmin=0, vmax=peak*np.max(psds), cmap="gray", aspect="auto")
-
             ax.set_xticks([0, self.bins//2, self.bins], labels=[f"{f_MHz[0]:.1f}", f"{f_MHz[self.bins//2]:.1f} MHz", f"{f_MHz[-1]:.1f}"])
             ax.set_yticks(hour_inds, labels=[f"{int(h)}h" for h in hours])
 
             ax.spines[['bottom', 'left']].set_position(('outward', 20))
 
+            vmax = peak*np.max(psds)
+
+            # Average frequency bins which would end up in the same pixel column
+            if decimate:
+                psds = decimate_mean(psds, display_columns(ax))
+
+            # Keep the x-axis in frequency bins, independent of the number of displayed columns
+            ax.imshow(psds, vmin=0, vmax=vmax, cmap="gray", aspect="auto", extent=(-0.5, self.bins - 0.5, self.num_meas - 0.5, -0.5))
+
             fig.savefig(path_waterfall(self.folder, window))
     
-    def save_spectra(self, format: str = "webp") -> None:
+    def save_spectra(self, format: str = "webp", decimate: bool = True) -> None:
         f_MHz = self.frequencies/1e6
 
         progressbar = Bar(len(self.windows)*self.num_meas, prefix="Creating PSD plots")
@@ -195,7 +216,6 @@ class Measurement:
 
                 fig, ax = plt.subplots()
                 ax.set_title(self.dates[i].strftime('%Y/%m/%d %H:%M:%S'), color="gray")
-                ax.plot(f_MHz, psd, color='k')
 
                 ax.set_xticks([f_MHz[0], f_MHz[self.bins//2], f_MHz[-1]], labels=[f"{f_MHz[0]:.1f}", f"{f_MHz[self.bins//2]:.1f} MHz", f"{f_MHz[-1]:.1f}"])
                 ax.spines[['bottom', 'left']].set_position(('outward', 20))
@@ -209,6 +229,11 @@ class Measurement:
                 ax.set_ylabel("Power (dBFS)", ha="left", y=1.03, rotation=0, labelpad=0)
                 ax.set_yticks(yticks)
 
+                if decimate:
+                    ax.plot(*decimate_minmax(f_MHz, psd, display_columns(ax)), color='k')
+                else:
+                    ax.plot(f_MHz, psd, color='k')
+
                 fig.savefig(path_spectra(self.folder, window, self.dates[i], format=format))
 
                 plt.close(fig)
@@ -220,7 +245,17 @@ class Measurement:
 
 class Reference:
 
+    # Number of cubic spline segments fitted to the bandpass in dB
+    MODEL_SEGMENTS: int = 128
+    # Minimum number of frequency bins per spline segment
+    MODEL_MIN_BINS: int = 16
+    # Residuals beyond this many robust standard deviations are kept as narrowband features, e.g. the DC spike and spurs
+    NARROWBAND_SIGMA: float = 5.0
+
     def __init__(self, name: str) -> None:
+        # Name of the stored files, which may differ from fname if the reference was renamed
+        self.name: str = name
+
         self.fname: str = ""
         self.bins: int = 0
         self.sample_rate: int = 0
@@ -230,10 +265,17 @@ class Reference:
         self.center_freq: int = 0
 
         self.psd: Dict[str, NDArray[np.float64]] = {}
+        self.knots: NDArray[np.float64] = np.empty(0)
+        self.model: Dict[str, NDArray[np.float64]] = {}
+        self.narrowband: Dict[str, Tuple[NDArray[np.int64], NDArray[np.float64]]] = {}
 
-        # Load settings and measurement data
+        # Bandpass model evaluations, keyed by window, frequency grid and inclusion of narrowband features
+        self._bandpass_cache: Dict[Tuple[str, int, int, int, bool], NDArray[np.float64]] = {}
+
+        # Load settings, measurement data and bandpass model
         self._load_settings(name)
         self._load_data(name)
+        self._load_model(name)
 
     def _load_settings(self, name: str) -> None:
         # Load settings from file
@@ -247,6 +289,139 @@ class Reference:
     def _load_data(self, name: str) -> None:
         self.psd = np.load(path_reference_data(name), allow_pickle=True).item()
 
+    def _load_model(self, name: str) -> None:
+        path = path_reference_model(name)
+
+        # Load the stored model if it was fitted with the current settings, otherwise refit it in memory
+        # Models with a missing fingerprint were stored in an older layout and are refitted as well
+        if path.is_file():
+            model = np.load(path, allow_pickle=True).item()
+            if model.get("fingerprint") == self.fingerprint and all(window in model["coefficients"] for window in self.psd):
+                self.knots = model["knots"]
+                self.model = model["coefficients"]
+                self.narrowband = model["narrowband"]
+                return
+
+        self.knots, self.model, self.narrowband = self.fit_model()
+
+    def save_model(self) -> None:
+        """
+        Store the bandpass model next to the reference data.
+        """
+        np.save(path_reference_model(self.name), {"fingerprint": self.fingerprint, "knots": self.knots, "coefficients": self.model, "narrowband": self.narrowband})
+
+    @property
+    def fingerprint(self) -> Dict[str, int]:
+        """
+        Identifies the reference data and fit settings a stored model belongs to.
+        """
+        return {
+            "data_mtime": path_reference_data(self.name).stat().st_mtime_ns,
+            "bins": self.bins,
+            "sample_rate": self.sample_rate,
+            "center_freq": self.center_freq,
+            "segments": self.MODEL_SEGMENTS,
+            "min_bins": self.MODEL_MIN_BINS,
+            "narrowband_sigma": self.NARROWBAND_SIGMA,
+        }
+
+    def fit_model(self) -> Tuple[NDArray[np.float64], Dict[str, NDArray[np.float64]], Dict[str, Tuple[NDArray[np.int64], NDArray[np.float64]]]]:
+        """
+        Fit a smooth bandpass model to the reference PSD of each window function.
+
+        The model is a least-squares cubic spline of the PSD in dBFS over the normalized frequency offset from the center frequency.
+        Its knots are spaced evenly, so the roll-off at the band edges is tracked locally without ringing across the passband.
+        Narrowband features, such as the DC spike and spurs, are excluded from the fit and kept as a sparse residual instead.
+
+        Returns:
+        ---
+        - Knot vector of the splines.
+        - Spline coefficients per window function.
+        - Bin indices and residuals in dB of the narrowband features per window function.
+        """
+        x = self._normalized_offset(self.frequencies)
+
+        segments = max(min(self.MODEL_SEGMENTS, self.bins//self.MODEL_MIN_BINS), 1)
+        knots = np.concatenate(([x[0]]*3, np.linspace(x[0], x[-1], num=segments + 1), [x[-1]]*3))
+
+        model = {}
+        narrowband = {}
+        for window, psd in self.psd_dBFS.items():
+            spline = make_lsq_spline(x, psd, knots, k=3)
+
+            # Refit with narrowband features weighted down, so they don't pull the smooth bandpass towards them
+            for _ in range(2):
+                mask = self._narrowband_mask(psd - spline(x))
+                spline = make_lsq_spline(x, psd, knots, k=3, w=np.where(mask, 1e-3, 1.0))
+
+            residual = psd - spline(x)
+            mask = self._narrowband_mask(residual)
+
+            model[window] = spline.c
+            narrowband[window] = (np.flatnonzero(mask), residual[mask])
+
+        return knots, model, narrowband
+
+    def _narrowband_mask(self, residual: NDArray[np.float64]) -> NDArray[np.bool_]:
+        # Robust estimate of the standard deviation of the residual noise
+        sigma = 1.4826*np.median(np.abs(residual - np.median(residual)))
+        return np.abs(residual) > self.NARROWBAND_SIGMA*sigma
+
+    def residuals(self) -> Dict[str, Tuple[float, float]]:
+        """
+        Residuals of the smooth bandpass model with respect to the reference PSD, excluding narrowband features.
+
+        Returns:
+        ---
+        - RMS and maximum absolute residual in dB per window function.
+        """
+        residuals = {}
+        for window, psd in self.psd_dBFS.items():
+            error = psd - 10*np.log10(self.bandpass(window, self.bins, self.sample_rate, self.center_freq, narrowband=False))
+            error = np.delete(error, self.narrowband[window][0])
+            residuals[window] = (float(np.sqrt(np.mean(error**2))), float(np.max(np.abs(error))))
+
+        return residuals
+
+    def on_grid(self, bins: int, sample_rate: int, center_freq: int) -> bool:
+        """
+        Whether a frequency grid equals the grid of the reference, on which narrowband features can be corrected.
+        """
+        return bins == self.bins and sample_rate == self.sample_rate and center_freq == self.center_freq
+
+    def bandpass(self, window: str, bins: int, sample_rate: int, center_freq: int, narrowband: bool = True) -> NDArray[np.float64]:
+        """
+        Evaluate the bandpass model on a frequency grid. Results are cached per window and grid.
+
+        Parameters:
+        ---
+        - window: Window function of the model.
+        - bins: Number of frequency bins of the grid.
+        - sample_rate: Sample rate in Hz spanned by the grid.
+        - center_freq: Center frequency in Hz of the grid.
+        - narrowband: Include the narrowband features. These only apply if the grid equals the grid of the reference.
+
+        Returns:
+        ---
+        - Linear PSD of the bandpass model.
+        """
+        key = (window, bins, sample_rate, center_freq, narrowband)
+
+        if key not in self._bandpass_cache:
+            frequencies = np.linspace(-0.5, 0.5, num=bins)*sample_rate + center_freq
+            model = BSpline(self.knots, self.model[window], 3)(self._normalized_offset(frequencies))
+
+            if narrowband and self.on_grid(bins, sample_rate, center_freq):
+                inds, residual = self.narrowband[window]
+                model[inds] += residual
+
+            self._bandpass_cache[key] = np.power(10, model/10)
+
+        return self._bandpass_cache[key]
+
+    def _normalized_offset(self, frequencies: NDArray[np.float64]) -> NDArray[np.float64]:
+        return (frequencies - self.center_freq)/self.sample_rate
+
     @property
     def psd_dBFS(self) -> Dict[str, NDArray[np.float64]]:
         return dict((k, 10*np.log10(v)) for k, v in self.psd.items())
@@ -259,7 +434,7 @@ class Reference:
     def frequencies(self) -> NDArray[np.float64]:
         return np.linspace(-0.5, 0.5, num=self.bins)*self.sample_rate + self.center_freq
     
-    def save_spectrum(self, format: str = "webp") -> None:
+    def save_spectrum(self, format: str = "webp", decimate: bool = True) -> None:
         f_MHz = self.frequencies/1e6
 
         for window, psd in self.psd.items():
@@ -267,8 +442,6 @@ class Reference:
 
             fig, ax = plt.subplots()
             ax.set_title(self.fname + " " + window, color="gray")
-            ax.plot(f_MHz, psd, color='k')
-
             ax.set_xticks([f_MHz[0], f_MHz[self.bins//2], f_MHz[-1]], labels=[f"{f_MHz[0]:.1f}", f"{f_MHz[self.bins//2]:.1f} MHz", f"{f_MHz[-1]:.1f}"])
             ax.spines[['bottom', 'left']].set_position(('outward', 20))
 
@@ -281,6 +454,19 @@ class Reference:
             ax.set_ylabel("Power (dBFS)", ha="left", y=1.03, rotation=0, labelpad=0)
             # ax.set_yticks(yticks)
 
+            model = 10*np.log10(self.bandpass(window, self.bins, self.sample_rate, self.center_freq, narrowband=False))
+
+            if decimate:
+                columns = display_columns(ax)
+
+                # The smooth model only needs subsampling, including both end points
+                inds = np.unique(np.linspace(0, self.bins - 1, num=columns).astype(int))
+                ax.plot(*decimate_minmax(f_MHz, psd, columns), color='k')
+                ax.plot(f_MHz[inds], model[inds], color='gray')
+            else:
+                ax.plot(f_MHz, psd, color='k')
+                ax.plot(f_MHz, model, color='gray')
+
             fig.savefig(path_reference() / f"{self.fname}_{window}.{format}")
 
             plt.close(fig)
\ No newline at end of file
@@ -1,5 +1,6 @@
 import numpy as np
-from typing import List, Callable
+from typing import List, Callable, Tuple
+from numpy.typing import NDArray
 
 def format_timedelta(td) -> str:
     total_seconds = td.total_seconds()
@@ -54,4 +55,64 @@ class Bar:
         if len(self.prefix) > 0:
             return self.prefix + " " + bar
         else:
-            return self.prefix + bar
\ No newline at end of file
+            return self.prefix + bar
+
+def display_columns(ax) -> int:
+    """
+    Number of pixel columns spanned by the width of the axes when saved.
+
+    The figure layout is computed first, so set titles, ticks and labels before calling this.
+    """
+    ax.figure.draw_without_rendering()
+    return max(int(ax.get_window_extent().width), 1)
+
+def decimate_minmax(x: NDArray, y: NDArray, columns: int) -> Tuple[NDArray, NDArray]:
+    """
+    Reduce a line to its min/max envelope per display column.
+
+    Parameters:
+    ---
+    - x: Horizontal coordinates of the line.
+    - y: Vertical coordinates of the line.
+    - columns: Number of display columns.
+
+    Returns:
+    ---
+    - Decimated x and y, keeping the minimum and maximum of each column in their original order.
+    """
+    n = len(y)
+    if n <= 2*columns:
+        return x, y
+
+    # Split the line in equally sized blocks, padding the last one with its final value
+    size = int(np.ceil(n/columns))
+    blocks = np.pad(y, (0, size*int(np.ceil(n/size)) - n), mode="edge").reshape(-1, size)
+    starts = np.arange(blocks.shape[0])[:, np.newaxis]*size
+
+    inds = np.sort(np.hstack((np.argmin(blocks, axis=1)[:, np.newaxis], np.argmax(blocks, axis=1)[:, np.newaxis])) + starts, axis=1).ravel()
+    inds = np.minimum(inds, n - 1)
+
+    return x[inds], y[inds]
+
+def decimate_mean(z: NDArray, columns: int) -> NDArray:
+    """
+    Block-average the columns of an image down to the number of display columns.
+
+    Parameters:
+    ---
+    - z: Image with shape (rows, columns).
+    - columns: Number of display columns.
+
+    Returns:
+    ---
+    - Image with exactly the given number of columns, or the image itself if it has no more columns than that.
+    """
+    n = z.shape[1]
+    if n <= columns:
+        return z
+
+    # Block sizes differ by at most one column, so each block is drawn at its true width within one bin
+    starts = np.linspace(0, n, num=columns + 1).astype(int)[:-1]
+    counts = np.diff(np.append(starts, n))
+
+    return np.add.reduceat(z, starts, axis=1)/counts
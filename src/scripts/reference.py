@@ -5,7 +5,7 @@ import argparse
 from rtlsdr.rtlsdr import LibUSBError
 
 from hydrogenline.sdr import SDR
-from hydrogenline.data import path_reference_settings, path_reference_data
+from hydrogenline.data import Reference, path_reference_settings, path_reference_data, path_reference_model
 from hydrogenline.utils import Bar, convert_windows_to_functions
 
 def main():
@@ -59,6 +59,20 @@ def main():
 
     progressbar.finish()
 
+    # Fit and store the bandpass model, discarding the model of a previous capture with the same name
+    path_reference_model(args.fname).unlink(missing_ok=True)
+    reference = Reference(args.fname)
+    reference.save_model()
+
+    f_MHz = reference.frequencies/1e6
+    for window, (rms, peak) in reference.residuals().items():
+        print(f"Bandpass model residual {window}: {rms:.2f} dB RMS, {peak:.2f} dB max", flush=True)
+
+        # Report the worst narrowband features, which are only corrected for measurements with the same frequency bins
+        inds, residual = reference.narrowband[window]
+        worst = np.argsort(np.abs(residual))[::-1][:5]
+        print(f"Narrowband features {window}: {len(inds)} bins" + "".join(f", {f_MHz[inds[i]]:.4f} MHz {residual[i]:+.2f} dB" for i in worst), flush=True)
+
     print("Done!", flush=True)
 
 if __name__ == "__main__":
@@ -9,9 +9,10 @@ def main():
     parser.add_argument("-b", "--bins", type=int, default=1, help="Number of bins for the moving median across frequency. Set to 1 to disable. Disabled by default.")
     parser.add_argument("-m", "--meas", type=int, default=1, help="Number of measurements for the moving median across time. Set to 1 to disable. Disabled by default.")
     parser.add_argument("-p", "--peak", type=float, default=0.1, help="Peak value on color scale with respect to the maximum value of the data. Defaults to 0.1.")
+    parser.add_argument("--no-decimate", action="store_true", help="Plot all frequency bins instead of reducing them to the pixel columns of the figure.")
 
     args = parser.parse_args()
-    Measurement(args.folder).save_waterfall(args.peak)
+    Measurement(args.folder).save_waterfall(args.peak, decimate=not args.no_decimate)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file